@@ -1,14 +1,48 @@
 from __future__ import annotations
 
-import json
+import asyncio
+import functools
 import logging
+import mmap
+import os
+import re
 from dataclasses import dataclass
 from pathlib import Path
-from urllib.parse import parse_qs, urlparse
+from typing import TYPE_CHECKING, NamedTuple, TypeVar
 
+import aiometer
+import httpx
+import ijson
+import lxml.html
+import orjson
 import requests
-from bs4 import BeautifulSoup
-from tqdm import tqdm
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+from tqdm.asyncio import tqdm
+from urllib3.util import Retry
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+T = TypeVar("T")
+
+_RETRY_TOTAL = 3
+_RETRY_BACKOFF_FACTOR = 0.3
+_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+_UNAPPLIED_STATUSES = frozenset({429})
+
+# The baseline requests session had no timeout; httpx's 5s default would turn
+# one slow page into a run-aborting ReadTimeout, so allow far more headroom.
+_HTTP_TIMEOUT = httpx.Timeout(30)
+
+_INVALID_LOGIN_MSG = "Invalid Email or password."
+_DECK_INFO_CARD_RE = re.compile(r"\bdeck-info-card\b")
+_SRS_RE = re.compile(r"SRS")
+_DECK_ID_RE = re.compile(r"[?&]deck_id=(\d+)")
+_NEXT_START = b'<script id="__NEXT_DATA__"'
+_SCRIPT_END = b"</script>"
+_NEXT_RE = re.compile(rb'<script id="__NEXT_DATA__"[^>]*>(.*?)</script>', re.DOTALL)
+_HTML_PARSER = lxml.html.HTMLParser(recover=True, encoding="utf-8")
 
 
 @dataclass
@@ -17,12 +51,44 @@ class Credentials:
     password: str
 
 
+class GrammarPoint(NamedTuple):
+    url: str
+    srs: str | None
+    reviewable_id: int
+    deck_id: int
+
+
 class BunproClient:
-    def __init__(self, email: str, password: str) -> None:
+    def __init__(
+        self,
+        email: str,
+        password: str,
+        max_per_second: float = 5,
+        max_at_once: int = 8,
+    ) -> None:
         self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(
+                total=_RETRY_TOTAL,
+                backoff_factor=_RETRY_BACKOFF_FACTOR,
+                status_forcelist=_RETRY_STATUSES,
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.headers.update(
+            {"Accept-Encoding": "gzip, br", "Connection": "keep-alive"},
+        )
         self.credentials = Credentials(email=email, password=password)
         self.logged_in = False
         self.base_url = "https://bunpro.jp"
+        self.add_to_reviews_url = f"{self.base_url}/api/frontend/reviews/add_to_reviews"
+        self.update_review_url_tmpl = (
+            f"{self.base_url}/api/frontend/reviews/{{}}/update_via_action_type"
+        )
+        self.max_per_second = max_per_second
+        self.max_at_once = max_at_once
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
 
@@ -45,10 +111,10 @@ class BunproClient:
             response = self.session.get(login_page_url)
             response.raise_for_status()
 
-            soup = BeautifulSoup(response.text, "html.parser")
-            authenticity_token = soup.find("input", {"name": "authenticity_token"})[
-                "value"
-            ]
+            doc = lxml.html.fromstring(response.content, parser=_HTML_PARSER)
+            authenticity_token = doc.find(".//input[@name='authenticity_token']").get(
+                "value",
+            )
 
             login_data = {
                 "utf8": "✓",
@@ -61,16 +127,20 @@ class BunproClient:
 
             login_response = self.session.post(login_page_url, data=login_data)
 
-            error_soup = BeautifulSoup(login_response.text, "html.parser")
+            if _INVALID_LOGIN_MSG.encode() in login_response.content:
+                error_doc = lxml.html.fromstring(
+                    login_response.content,
+                    parser=_HTML_PARSER,
+                )
 
-            errors_div = error_soup.find("div", {"class": "errors"})
-            if errors_div:
-                alert_div = errors_div.find("div", {"class": "alert"})
-                if alert_div and "Invalid Email or password." in alert_div.text:
-                    return (
-                        False,
-                        "Invalid email/password. Please check your Bunpro credentials.",
-                    )
+                for errors_div in error_doc.find_class("errors"):
+                    for alert_div in errors_div.find_class("alert"):
+                        if _INVALID_LOGIN_MSG in alert_div.text_content():
+                            return (
+                                False,
+                                "Invalid email/password."
+                                " Please check your Bunpro credentials.",
+                            )
 
             if login_response.status_code != requests.codes.ok:
                 return (
@@ -87,60 +157,193 @@ class BunproClient:
             return True, ""
 
     def save_data_to_disk(self, data: dict | list, path: Path) -> None:
-        with path.open("w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        path.write_bytes(
+            orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS),
+        )
 
     def load_data_from_disk(self, path: Path) -> dict | list:
-        with path.open("r", encoding="utf-8") as f:
-            return json.load(f)
+        return orjson.loads(path.read_bytes())
+
+    def load_known_kanji_from_disk(self, path: Path) -> list[str]:
+        with path.open("rb") as f, mmap.mmap(
+            f.fileno(),
+            0,
+            access=mmap.ACCESS_READ,
+        ) as buf:
+            return [
+                value
+                for prefix, event, value in ijson.parse(buf)
+                if prefix == "known_kanji" and event == "map_key"
+            ]
 
     def backup_grammar(self, deck_url: str) -> None:
-        self.ensure_login()
+        self.backup([deck_url], include_kanji=False)
+
+    def _collect_points(self, deck_url: str) -> list[tuple[str, str | None]]:
         self.logger.info("Starting backup for %s", deck_url)
 
         stats_url = self.base_url + deck_url
         stats_response = self.session.get(stats_url)
         stats_response.raise_for_status()
 
-        soup = BeautifulSoup(stats_response.text, "html.parser")
+        soup = BeautifulSoup(
+            stats_response.content,
+            "lxml",
+            parse_only=SoupStrainer("div", class_=_DECK_INFO_CARD_RE),
+        )
         sections = soup.find_all("div", class_="deck-info-card")
 
-        data = []
-        for section in tqdm(sections):
+        points = []
+        for section in sections:
             a_tag = section.find("a", href=True)
             url = a_tag["href"] if a_tag else None
 
-            srs_span = section.find("span", string=lambda s: s and "SRS" in s)
+            srs_span = section.find("span", string=_SRS_RE)
             srs_text = srs_span.get_text(strip=True) if srs_span else None
 
-            soup = BeautifulSoup(
-                self.session.get(self.base_url + url).text,
-                "html.parser",
-            )
-            script_tag = soup.find(
-                "script",
-                id="__NEXT_DATA__",
-                type="application/json",
+            points.append((url, srs_text))
+
+        return points
+
+    async def _fetch_points(
+        self,
+        points: list[tuple[str, str | None]],
+        desc: str,
+    ) -> list[GrammarPoint]:
+        # Over HTTP/2 every detail-page GET is a stream on one connection, so
+        # the whole backup costs one TLS handshake. The pool still allows one
+        # connection per in-flight job so an HTTP/1.1 fallback isn't serialized.
+        async with httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=self.max_at_once,
+                max_keepalive_connections=self.max_at_once,
+            ),
+            timeout=_HTTP_TIMEOUT,
+            follow_redirects=True,
+            cookies=self.session.cookies,
+        ) as client:
+            return await self._run_limited(
+                [
+                    functools.partial(self._fetch_point, client, url, srs_text)
+                    for url, srs_text in points
+                ],
+                desc=desc,
             )
-            script_data = json.loads(script_tag.string)
-            reviewable_id = int(script_data["props"]["pageProps"]["reviewable"]["id"])
-
-            query = parse_qs(urlparse(url).query)
-            deck_id = int(query.get("deck_id", [None])[0])
-
-            data.append(
-                {
-                    "url": url,
-                    "srs": srs_text,
-                    "reviewable_id": reviewable_id,
-                    "deck_id": deck_id,
-                },
+
+    async def _run_limited(
+        self,
+        jobs: list[Callable[[], Awaitable[T]]],
+        desc: str,
+    ) -> list[T]:
+        # Pace requests with a token bucket so concurrent runs stay under
+        # Bunpro's rate limit instead of bouncing off 429s.
+        with tqdm(total=len(jobs), desc=desc) as pbar:
+
+            async def run(job: Callable[[], Awaitable[T]]) -> T:
+                result = await job()
+                pbar.update()
+                return result
+
+            return await aiometer.run_all(
+                [functools.partial(run, job) for job in jobs],
+                max_at_once=self.max_at_once,
+                max_per_second=self.max_per_second,
             )
 
-        deck_backup_file_path = (
-            self.base_path / f"deck_{deck_url.split('/')[-1].lower()}"
-        ).with_suffix(".json")
-        self.save_data_to_disk(data, deck_backup_file_path)
+    async def _request_with_retry(
+        self,
+        client: httpx.AsyncClient,
+        method: str,
+        url: str,
+        *,
+        stream: bool = False,
+        **kwargs,
+    ) -> httpx.Response:
+        # Follows urllib3's Retry rules for the httpx hot paths: idempotent
+        # methods retry on any _RETRY_STATUSES code or transport error, while
+        # the non-idempotent PATCHes only retry when the request can't have
+        # been applied: a 429 rejection, or a failure to connect at all.
+        idempotent = method in Retry.DEFAULT_ALLOWED_METHODS
+        retry_statuses = _RETRY_STATUSES if idempotent else _UNAPPLIED_STATUSES
+        request = client.build_request(method, url, **kwargs)
+        attempt = 0
+        while True:
+            delay = _RETRY_BACKOFF_FACTOR * 2**attempt
+            try:
+                response = await client.send(request, stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+                if attempt == _RETRY_TOTAL:
+                    raise
+            except httpx.TransportError:
+                if not idempotent or attempt == _RETRY_TOTAL:
+                    raise
+            else:
+                if response.status_code not in retry_statuses or (
+                    attempt == _RETRY_TOTAL
+                ):
+                    return response
+
+                await response.aclose()
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = int(retry_after)
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _fetch_point(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        srs_text: str | None,
+    ) -> GrammarPoint:
+        # Stream the page, scanning for the __NEXT_DATA__ script as it arrives.
+        # Only HTTP/2 stops reading once it's found: closing a partly read
+        # HTTP/1.1 body drops the connection, costing a new TCP+TLS handshake.
+        buf = bytearray()
+        # Each search resumes where the previous chunk's left off, so the page
+        # is scanned once rather than from the start after every chunk.
+        start = end = -1
+        pos = 0
+        response = await self._request_with_retry(
+            client,
+            "GET",
+            self.base_url + url,
+            stream=True,
+        )
+        try:
+            response.raise_for_status()
+            stop_early = response.http_version == "HTTP/2"
+            async for chunk in response.aiter_bytes(65536):
+                if end >= 0:
+                    continue
+                buf += chunk
+                if start < 0:
+                    start = buf.find(_NEXT_START, pos)
+                    if start < 0:
+                        pos = max(0, len(buf) - len(_NEXT_START) + 1)
+                        continue
+                    pos = start
+                end = buf.find(_SCRIPT_END, pos)
+                if end >= 0:
+                    if stop_early:
+                        break
+                    continue
+                pos = max(start, len(buf) - len(_SCRIPT_END) + 1)
+        finally:
+            await response.aclose()
+
+        if end < 0:
+            msg = f"No __NEXT_DATA__ script found in {url}"
+            raise ValueError(msg)
+
+        script_data = orjson.loads(_NEXT_RE.match(buf, start).group(1))
+        reviewable_id = int(script_data["props"]["pageProps"]["reviewable"]["id"])
+
+        deck_id = int(_DECK_ID_RE.search(url).group(1))
+
+        return GrammarPoint(url, srs_text, reviewable_id, deck_id)
 
     def backup_kanji(self) -> None:
         self.ensure_login()
@@ -155,58 +358,160 @@ class BunproClient:
         )
         response.raise_for_status()
 
-        self.save_data_to_disk(response.json(), self.kanji_backup_file_path)
+        self.save_data_to_disk(
+            orjson.loads(response.content),
+            self.kanji_backup_file_path,
+        )
+
+    def backup(self, deck_urls: list[str], *, include_kanji: bool = True) -> None:
+        self.ensure_login()
+
+        points_by_deck = {
+            deck_url: self._collect_points(deck_url) for deck_url in deck_urls
+        }
+
+        # Every deck's detail pages go through one _run_limited call, so
+        # max_per_second caps the whole backup rather than each deck.
+        data = asyncio.run(
+            self._fetch_points(
+                [point for points in points_by_deck.values() for point in points],
+                desc=f"Backing up {len(deck_urls)} deck(s)",
+            ),
+        )
+
+        offset = 0
+        for deck_url, points in points_by_deck.items():
+            deck_data = data[offset : offset + len(points)]
+            offset += len(points)
+
+            deck_backup_file_path = (
+                self.base_path / f"deck_{deck_url.split('/')[-1].lower()}"
+            ).with_suffix(".json")
+            self.save_data_to_disk(
+                [point._asdict() for point in deck_data],
+                deck_backup_file_path,
+            )
 
-    def backup(self, deck_urls: list[str]) -> None:
-        for deck_url in deck_urls:
-            self.backup_grammar(deck_url)
-        self.backup_kanji()
+        if include_kanji:
+            self.backup_kanji()
 
     def restore_grammar(self, file_path: Path) -> None:
         self.ensure_login()
-        self.logger.info("Starting restore for %s", file_path.name)
+        asyncio.run(self._restore_files([file_path]))
 
+    async def _restore_files(self, file_paths: list[Path]) -> None:
         token = self.session.cookies.get("frontend_api_token")
 
-        data = self.load_data_from_disk(file_path)
-
-        for point in tqdm(data):
-            if point["srs"]:
-                response = self.session.patch(
-                    self.base_url + "/api/frontend/reviews/add_to_reviews",
-                    json={
-                        "reviewable_id": point["reviewable_id"],
-                        "reviewable_type": "GrammarPoint",
-                        "deck_id": point["deck_id"],
-                    },
-                    headers={"authorization": f"Token token={token}"},
-                )
-                id_ = response.json()["data"]["id"]
-                self.session.patch(
-                    self.base_url
-                    + f"/api/frontend/reviews/{id_}/update_via_action_type",
-                    json={
-                        "action_type": "set_streak",
-                        "new_streak": int(point["srs"].split()[1]),
-                    },
-                    headers={"authorization": f"Token token={token}"},
+        # One HTTP/2 connection is shared by every deck, so all PATCH chains
+        # are multiplexed as streams behind a single TLS handshake.
+        async with httpx.AsyncClient(
+            http2=True,
+            headers={"authorization": f"Token token={token}"},
+            timeout=_HTTP_TIMEOUT,
+            cookies=self.session.cookies,
+        ) as client:
+            for file_path in file_paths:
+                self.logger.info("Starting restore for %s", file_path.name)
+
+                data = self.load_data_from_disk(file_path)
+
+                # Reviewable ids already restored by an interrupted earlier run
+                # are recorded one per line in a sidecar file and skipped here.
+                progress_path = file_path.with_name(f"{file_path.stem}.progress")
+                done = self.load_restore_progress(progress_path)
+
+                progress_fd = os.open(
+                    progress_path,
+                    os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                    0o644,
                 )
+                try:
+                    results = await self._run_limited(
+                        [
+                            functools.partial(
+                                self._restore_point,
+                                client,
+                                point,
+                                progress_fd,
+                            )
+                            for point in data
+                            if point["srs"] and point["reviewable_id"] not in done
+                        ],
+                        desc=f"Restoring {file_path.stem}",
+                    )
+                finally:
+                    os.close(progress_fd)
+
+                if all(results):
+                    progress_path.unlink()
+                else:
+                    self.logger.warning(
+                        "%d points failed to restore for %s; rerun to retry them.",
+                        results.count(False),
+                        file_path.name,
+                    )
+
+    def load_restore_progress(self, path: Path) -> set[int]:
+        if not path.exists():
+            return set()
+        with path.open("r", encoding="utf-8") as f:
+            return {int(line) for line in f if line.strip()}
+
+    async def _restore_point(
+        self,
+        client: httpx.AsyncClient,
+        point: dict,
+        progress_fd: int,
+    ) -> bool:
+        response = await self._request_with_retry(
+            client,
+            "PATCH",
+            self.add_to_reviews_url,
+            json={
+                "reviewable_id": point["reviewable_id"],
+                "reviewable_type": "GrammarPoint",
+                "deck_id": point["deck_id"],
+            },
+        )
+        if not response.is_success:
+            return False
+
+        # Only a successful response's Location can name the new review; a
+        # redirect (e.g. to /users/sign_in) must not be read as an id.
+        location_id = response.headers.get("Location", "").rsplit("/", 1)[-1]
+        if location_id.isdigit():
+            id_ = int(location_id)
+        else:
+            id_ = orjson.loads(response.content)["data"]["id"]
+        response = await self._request_with_retry(
+            client,
+            "PATCH",
+            self.update_review_url_tmpl.format(id_),
+            json={
+                "action_type": "set_streak",
+                "new_streak": int(point["srs"].split()[1]),
+            },
+        )
+        if response.status_code != httpx.codes.OK:
+            return False
+        os.write(progress_fd, f"{point['reviewable_id']}\n".encode())
+        return True
 
     def restore_kanji(self) -> None:
         self.ensure_login()
         token = self.session.cookies.get("frontend_api_token")
 
         kanji_url = self.base_url + "/api/frontend/user/add_known_kanji"
-        data = self.load_data_from_disk(self.kanji_backup_file_path)
+        kanjis = self.load_known_kanji_from_disk(self.kanji_backup_file_path)
 
         response = self.session.post(
             kanji_url,
-            json={"kanjis": list(data["known_kanji"].keys())},
+            json={"kanjis": kanjis},
             headers={"authorization": f"Token token={token}"},
         )
         response.raise_for_status()
 
     def restore(self) -> None:
-        for path in self.base_path.glob("deck_*"):
-            self.restore_grammar(path)
+        self.ensure_login()
+        asyncio.run(self._restore_files(list(self.base_path.glob("deck_*.json"))))
         self.restore_kanji()
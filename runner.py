@@ -16,6 +16,14 @@ DEFAULT_DECKS = [
 ]
 
 
+def positive_float(value: str) -> float:
+    number = float(value)
+    if not number > 0:
+        msg = f"must be greater than 0, got {value}"
+        raise argparse.ArgumentTypeError(msg)
+    return number
+
+
 if __name__ == "__main__":
     """
     CLI for backup / restore.
@@ -71,6 +79,12 @@ if __name__ == "__main__":
         "-p",
         help="Bunpro login password (overrides .env / environment variable)",
     )
+    parser.add_argument(
+        "--max-per-second",
+        type=positive_float,
+        default=5,
+        help="Maximum grammar points fetched/restored per second (default: 5).",
+    )
     parser.add_argument(
         "--verbose",
         "-v",
@@ -99,7 +113,11 @@ if __name__ == "__main__":
         sys.exit(2)
 
     # initialize client
-    client = BunproClient(email=email, password=password)
+    client = BunproClient(
+        email=email,
+        password=password,
+        max_per_second=args.max_per_second,
+    )
 
     try:
         if args.command == "backup":